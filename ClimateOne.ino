@@ -43,11 +43,15 @@ float HUM_OFF_RH = 60.0;
 
 // serial input buffer
 String rxLine;
+// request id of the command being handled ("<seq>,<cmd>"), echoed in STATUS; -1 = none
+long rxSeq = -1;
 
 
 
 void sendStatus(float tC, bool tValid, float h, bool hValid) {
-  Serial.print(F("STATUS,temp="));
+  Serial.print(F("STATUS,"));
+  if (rxSeq >= 0) { Serial.print(rxSeq); Serial.print(','); }
+  Serial.print(F("temp="));
   if (tValid) Serial.print(tC, 2); else Serial.print(F("nan"));
   Serial.print(F(",hum="));
   if (hValid) Serial.print(h, 2); else Serial.print(F("nan"));
@@ -60,8 +64,20 @@ void sendStatus(float tC, bool tValid, float h, bool hValid) {
   Serial.print(F(",hum_off="));  Serial.println(HUM_OFF_RH, 2);
 }
 
+// Splits an optional "<seq>," prefix off a command line into rxSeq.
+String stripSeq(const String &line) {
+  rxSeq = -1;
+  int c = line.indexOf(',');
+  if (c <= 0) return line;
+  for (int i = 0; i < c; i++) {
+    if (!isDigit(line.charAt(i))) return line;
+  }
+  rxSeq = line.substring(0, c).toInt();
+  return line.substring(c + 1);
+}
+
 void handleCommand(const String &line, float tC, bool tValid, float h, bool hValid) {
-  // Commands:
+  // Commands (each may be prefixed with "<seq>,", see stripSeq):
   // GET
   // MODE,AUTO|MANUAL
   // SET,heater,0|1
@@ -116,6 +132,21 @@ void handleCommand(const String &line, float tC, bool tValid, float h, bool hVal
 
 
 
+void pollSerial(float tC, bool tValid, float h, bool hValid) {
+  while (Serial.available()) {
+    char c = (char)Serial.read();
+    if (c == '\n' || c == '\r') {
+      if (rxLine.length()) {
+        handleCommand(stripSeq(rxLine), tC, tValid, h, hValid);
+        rxSeq = -1;
+        rxLine = "";
+      }
+    } else {
+      if (rxLine.length() < 200) rxLine += c;
+    }
+  }
+}
+
 void applyOutputs() {
   // Invert RELAY_* writes here if your relays are active-LOW
   digitalWrite(LED_HEAT_PIN,    heaterOn ? HIGH : LOW);
@@ -230,17 +261,9 @@ void loop() {
 
   if (display.width() > 0) oledShow(tC, tValid, h, hValid);
 
-  while (Serial.available()) {
-  char c = (char)Serial.read();
-  if (c == '\n' || c == '\r') {
-    if (rxLine.length()) {
-      handleCommand(rxLine, tC, tValid, h, hValid);
-      rxLine = "";
-    }
-  } else {
-    if (rxLine.length() < 200) rxLine += c;
+  // idle ~2 s, but keep answering commands so the host never waits a whole loop
+  unsigned long t0 = millis();
+  while (millis() - t0 < 2000) {
+    pollSerial(tC, tValid, h, hValid);
   }
 }
-
-  delay(2000);
-}
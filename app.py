@@ -1,23 +1,47 @@
 # app.py
-import subprocess, glob, io, json, os, sqlite3, threading, time, re
+import subprocess, glob, gzip, hashlib, io, json, os, shutil, sqlite3, threading, time, re, atexit, signal, sys
+from dataclasses import dataclass, replace
 from datetime import datetime, timedelta
 from flask import Flask, jsonify, request, Response, send_file
-import serial
+from serial_backend import SerialSource
+try:
+    import orjson  # optional: much faster JSON for /api/history
+except ImportError:
+    orjson = None
 
 
 
 # optional: configure via env vars
 FSWEBCAM_BIN = os.getenv("FSWEBCAM_BIN", "/usr/bin/fswebcam")
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "/usr/bin/ffmpeg")  # used for /stream.mjpg
 DEFAULT_CAM_DEV = int(os.getenv("CAM_DEV", "0"))  # 0 -> /dev/video0
 
 
 BAUD = 115200
 PORT_GLOBS = ["/dev/ttyACM*", "/dev/ttyUSB*"]
-SER_TIMEOUT = 1.5
+SER_TIMEOUT = 2.0   # serial reads block in the kernel up to this long
 LOCK = threading.Lock()
+# poller <-> /api/status handshake: handlers request an extra GET cycle and wait
+# until the cycle counter has moved past it
+POLL_COND = threading.Condition()
+_poll_gen = 0            # completed GET cycles
+_poll_busy = False       # a cycle is running right now
+_poll_requested = False  # a handler wants a cycle before the next scheduled one
+STATUS_WAIT = 4.0        # max seconds /api/status waits for a fresh GET
 
 DB_PATH = "smarthome.db"
+# "wal" (default): WAL + synchronous=NORMAL, survives power loss minus the last commits.
+# "low": journal in RAM and no fsync at all. Fastest, but a power cut or OS crash
+# mid-write can lose recent batches or even corrupt smarthome.db. Only for throwaway logs.
+# journal_mode=MEMORY also turns WAL off, so the read-only history connections and
+# the writer lock each other out again (busy_timeout makes them wait, not fail).
+DURABILITY = os.getenv("DURABILITY", "wal")
+if DURABILITY not in ("wal", "low"):
+    raise SystemExit("DURABILITY must be 'wal' or 'low', not {!r}".format(DURABILITY))
 POLL_INTERVAL = 10  # seconds
+BATCH_N = 6         # flush readings to disk every N rows...
+FLUSH_SECS = 60     # ...or every K seconds, whichever comes first
+MAX_PENDING = 360   # rows kept in memory while flushes fail (~1 h); oldest dropped beyond this
 
 
 SNAPSHOT_DIR = os.path.expanduser("~/ClimateOne/snaps")
@@ -30,324 +54,227 @@ if not os.path.isdir(SNAPSHOT_DIR):
 
 app = Flask(__name__)
 
+# gzip text responses (the dashboard HTML and /api/history JSON compress 5-10x)
+COMPRESS_MIMETYPES = ("text/html", "application/json")
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 500  # bytes; smaller bodies aren't worth the CPU
+
+@app.after_request
+def compress_response(resp):
+    if (resp.direct_passthrough or resp.is_streamed
+            or resp.status_code != 200
+            or "Content-Encoding" in resp.headers
+            or resp.mimetype not in COMPRESS_MIMETYPES
+            or "gzip" not in request.headers.get("Accept-Encoding", "")):
+        return resp
+    data = resp.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return resp
+    resp.set_data(gzip.compress(data, COMPRESS_LEVEL))
+    resp.headers["Content-Encoding"] = "gzip"
+    resp.vary.add("Accept-Encoding")
+    return resp
+
 # ---- serial helpers ----
-ser = None
-latest = {
-    "temp": None, "hum": None, "heater": 0, "fan": 0,
-    "mode": "AUTO",
-    "temp_on": 20.0, "temp_off": 24.0, "hum_on": 60.0, "hum_off": 60.0,
-    "updated": None, "port": None, "raw": ""
-}
-
-def find_port():
-    for pat in PORT_GLOBS:
-        matches = sorted(glob.glob(pat))
-        if matches:
-            return matches[0]
-    return None
-
-def open_serial():
-    global ser
-    port = find_port()
-    if not port:
-        return None
-    ser = serial.Serial(port, BAUD, timeout=SER_TIMEOUT)
-    time.sleep(2.0)  # allow MCU reset
-    latest["port"] = port
-    return ser
+source = SerialSource(BAUD, PORT_GLOBS, SER_TIMEOUT)
+
+@dataclass(frozen=True, slots=True)
+class Status:
+    """Last known controller state. Never mutated: send_cmd swaps in a new one."""
+    temp: float | None = None
+    hum: float | None = None
+    heater: int = 0
+    fan: int = 0
+    mode: str = "AUTO"
+    temp_on: float = 20.0
+    temp_off: float = 24.0
+    hum_on: float = 60.0
+    hum_off: float = 60.0
+    updated: float | None = None
+    port: str | None = None
+    raw: str = ""
+
+# readers take `snap = LATEST` once; rebinding the global is atomic, so no torn reads
+LATEST = Status()
 
 def send_cmd(cmd):
     """Send a command and parse a STATUS line."""
-    global ser
+    global LATEST
     with LOCK:
-        if ser is None or not ser.is_open:
-            if not open_serial():
-                return None
-        ser.reset_input_buffer()
-        ser.write((cmd + "\n").encode("utf-8"))
-        ser.flush()
-        t0 = time.time()
-        while time.time() - t0 < 2.0:
-            line = ser.readline().decode("utf-8", errors="ignore").strip()
-            if not line:
-                continue
-            if line.startswith("STATUS,"):
-                latest["raw"] = line
-                st = parse_status(line)
-                if st:
-                    latest.update(st)
-                    latest["updated"] = time.time()
-                return latest
-        return None
-
-def parse_status(line):
-    # STATUS,temp=23.45,hum=51.20,heater=0,fan=1,mode=AUTO,temp_on=20.0,...
-    try:
-        parts = line.split(",")[1:]  # skip "STATUS"
-        out = {}
-        for p in parts:
-            k, v = p.split("=", 1)
-            k = k.strip()
-            v = v.strip()
-            if k in ("temp", "hum", "temp_on", "temp_off", "hum_on", "hum_off"):
-                out[k] = float("nan" if v.lower()=="nan" else v)
-            elif k in ("heater","fan"):
-                out[k] = int(v)
-            elif k == "mode":
-                out[k] = v.upper()
-        return out
-    except Exception:
-        return None
+        reply = source.request(cmd)
+        if reply is None:
+            return None
+        line, st = reply
+        fields = dict(st, updated=time.time()) if st else {}
+        LATEST = replace(LATEST, port=source.port, raw=line.decode("utf-8", errors="ignore"), **fields)
+        return LATEST
 
 # ---- database ----
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA mmap_size=134217728;",
+    "PRAGMA busy_timeout=5000;",
+)
+_db_local = threading.local()
+_WRITER_CONN = None
+DB_LOCK = threading.Lock()
+
+def _get_conn():
+    """Per-thread cached read-only connection; never contends with the writer under WAL."""
+    con = getattr(_db_local, "con", None)
+    if con is None:
+        uri = "file:{}?mode=ro".format(os.path.abspath(DB_PATH))
+        con = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        con.execute("PRAGMA busy_timeout=5000;")
+        con.execute("PRAGMA temp_store=MEMORY;")
+        con.execute("PRAGMA mmap_size=134217728;")
+        _db_local.con = con
+    return con
+
 def db_init():
-    with sqlite3.connect(DB_PATH) as con:
-        con.execute("""
-            CREATE TABLE IF NOT EXISTS readings(
-              ts INTEGER NOT NULL,
-              temp REAL,
-              hum REAL,
-              heater INTEGER,
-              fan INTEGER
-            );
-        """)
-        con.execute("CREATE INDEX IF NOT EXISTS idx_ts ON readings(ts);")
+    global _WRITER_CONN
+    con = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+    # journal_mode=WAL is persistent in the db file; the rest are per-connection
+    for pragma in DB_PRAGMAS:
+        con.execute(pragma)
+    if DURABILITY == "low":
+        con.execute("PRAGMA journal_mode=MEMORY;")
+        con.execute("PRAGMA synchronous=OFF;")
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS readings(
+          ts INTEGER NOT NULL,
+          temp REAL,
+          hum REAL,
+          heater INTEGER,
+          fan INTEGER
+        );
+    """)
+    # covering index: range scans on ts never touch the table itself
+    con.execute("DROP INDEX IF EXISTS idx_ts;")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_ts_cov ON readings(ts, temp, hum, heater, fan);")
+    _WRITER_CONN = con
+
+_pending = []
+_last_flush = time.monotonic()
+
+def _flush_locked():
+    global _last_flush
+    _last_flush = time.monotonic()
+    if not _pending or _WRITER_CONN is None:
+        return
+    con = _WRITER_CONN
+    try:
+        con.execute("BEGIN")
+        con.executemany("INSERT INTO readings(ts,temp,hum,heater,fan) VALUES (?,?,?,?,?)", _pending)
+        con.execute("COMMIT")
+    except sqlite3.Error:
+        # SQLite may already have rolled back (SQLITE_BUSY, SQLITE_FULL, ...)
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        app.logger.exception("flushing %d readings failed; will retry", len(_pending))
+        if len(_pending) > MAX_PENDING:
+            dropped = len(_pending) - MAX_PENDING
+            del _pending[:dropped]
+            app.logger.error("dropped %d oldest unsaved readings", dropped)
+        return
+    del _pending[:]
+
+def flush_pending():
+    with DB_LOCK:
+        _flush_locked()
 
 def db_insert(st):
-    with sqlite3.connect(DB_PATH) as con:
-        con.execute(
-            "INSERT INTO readings(ts,temp,hum,heater,fan) VALUES (?,?,?,?,?)",
-            (int(st["updated"]), st.get("temp"), st.get("hum"), st.get("heater"), st.get("fan"))
-        )
-
-def db_get_since(since_epoch):
-    with sqlite3.connect(DB_PATH) as con:
-        rows = con.execute(
-            "SELECT ts,temp,hum,heater,fan FROM readings WHERE ts>=? ORDER BY ts ASC",
-            (since_epoch,)
+    # buffered: rows hit disk in one transaction per batch (see BATCH_N / FLUSH_SECS)
+    with DB_LOCK:
+        _pending.append((int(st.updated), st.temp, st.hum, st.heater, st.fan))
+        if len(_pending) >= BATCH_N or time.monotonic() - _last_flush > FLUSH_SECS:
+            _flush_locked()
+
+atexit.register(flush_pending)
+
+def db_get_since(since_epoch, bucket_s=None):
+    """Readings since `since_epoch`; with `bucket_s`, averaged into buckets of that many seconds."""
+    if bucket_s and bucket_s > 1:
+        return _get_conn().execute(
+            "SELECT (ts/?)*? AS b, AVG(temp), AVG(hum), MAX(heater), MAX(fan) "
+            "FROM readings WHERE ts>=? GROUP BY b ORDER BY b ASC",
+            (bucket_s, bucket_s, since_epoch)
         ).fetchall()
+    rows = _get_conn().execute(
+        "SELECT ts,temp,hum,heater,fan FROM readings WHERE ts>=? ORDER BY ts ASC",
+        (since_epoch,)
+    ).fetchall()
     return rows
 
 # ---- poller ----
 def poller():
+    global _poll_gen, _poll_busy, _poll_requested
+    next_due = time.monotonic()
     while True:
+        with POLL_COND:
+            POLL_COND.wait_for(lambda: _poll_requested, max(0.0, next_due - time.monotonic()))
+            _poll_requested = False
+            _poll_busy = True
+        # only scheduled cycles are stored, so readings stay POLL_INTERVAL apart
+        scheduled = time.monotonic() >= next_due
+        if scheduled:
+            next_due = time.monotonic() + POLL_INTERVAL
         try:
             st = send_cmd("GET")
-            if st and st.get("updated"):
+            if scheduled and st and st.updated:
                 db_insert(st)
         except Exception:
             pass
-        time.sleep(POLL_INTERVAL)
+        with POLL_COND:
+            _poll_busy = False
+            _poll_gen += 1
+            POLL_COND.notify_all()
+
+def latest_snapshot(keys):
+    """Some fields of LATEST, all from the same Status."""
+    snap = LATEST
+    return {k: getattr(snap, k) for k in keys}
 
 # ---- web UI ----
-HTML = """
-<!doctype html>
-<html>
-<head>
-<meta charset="utf-8" />
-<title>ClimateOne</title>
-<meta name="viewport" content="width=device-width, initial-scale=1" />
-<style>
-  :root{--card:#f6f7fb;--muted:#666}
-  body{font-family:system-ui,Segoe UI,Arial,sans-serif;max-width:980px;margin:20px auto;padding:0 14px}
-  h1{margin:.2rem 0}
-  .sub{color:var(--muted);margin-bottom:12px}
-  .grid{display:grid;grid-template-columns:repeat(auto-fit,minmax(260px,1fr));gap:12px}
-  .card{background:var(--card);border:1px solid #e7e9ef;border-radius:16px;padding:16px;box-shadow:0 2px 8px rgba(0,0,0,.04)}
-  .big{font-size:2.2rem;font-weight:700}
-  .row{display:flex;gap:8px;align-items:center;flex-wrap:wrap}
-  .pill{border:1px solid #ddd;border-radius:999px;padding:4px 10px;background:#fff}
-  button,input,select{padding:8px 10px;border-radius:10px;border:1px solid #ccc}
-  label{font-size:.9rem;color:#333;margin-right:6px}
-  img{max-width:100%;border-radius:12px;border:1px solid #ddd}
-  .mono{font-family:ui-monospace,monospace}
-  .sep{height:8px}
-  canvas{background:#fff;border:1px solid #e7e9ef;border-radius:12px;padding:6px}
-</style>
-</head>
-<body>
-  <h1>Smart Home</h1>
-  <div class="sub" id="meta">loading…</div>
-
-  <div class="grid">
-    <div class="card">
-      <div class="row" style="justify-content:space-between">
-        <div>
-          <div>Temperature</div>
-          <div class="big" id="t">--.- °C</div>
-        </div>
-        <div class="pill">Heater: <b id="heater">--</b></div>
-      </div>
-      <div class="sep"></div>
-      <div class="row">
-        <label>Mode</label>
-        <select id="modeSel" onchange="setMode(this.value)">
-          <option value="AUTO">AUTO</option>
-          <option value="MANUAL">MANUAL</option>
-        </select>
-        <button onclick="setDev('heater',1)">Heater ON</button>
-        <button onclick="setDev('heater',0)">Heater OFF</button>
-      </div>
-    </div>
-
-    <div class="card">
-      <div class="row" style="justify-content:space-between">
-        <div>
-          <div>Humidity</div>
-          <div class="big" id="h">--.- %</div>
-        </div>
-        <div class="pill">Fan: <b id="fan">--</b></div>
-      </div>
-      <div class="sep"></div>
-      <div class="row">
-        <button onclick="setDev('fan',1)">Fan ON</button>
-        <button onclick="setDev('fan',0)">Fan OFF</button>
-      </div>
-    </div>
-
-    <div class="card">
-      <div><b>Setpoints</b></div>
-      <div class="sep"></div>
-      <div class="row">
-        <label>Temp ON</label><input id="sp_ton" type="number" step="0.1" style="width:90px">
-        <label>Temp OFF</label><input id="sp_toff" type="number" step="0.1" style="width:90px">
-      </div>
-      <div class="row" style="margin-top:6px">
-        <label>Hum ON</label><input id="sp_hon" type="number" step="0.1" style="width:90px">
-        <label>Hum OFF</label><input id="sp_hoff" type="number" step="0.1" style="width:90px">
-      </div>
-      <div class="row" style="margin-top:8px">
-        <button onclick="saveSetpoints()">Save</button>
-      </div>
-      <div class="mono" id="port" style="margin-top:8px;color:#555"></div>
-    </div>
-
-    <div class="card">
-      <div class="row" style="justify-content:space-between">
-        <div><b>Camera</b></div>
-        <div><button onclick="snap()">Snapshot</button></div>
-      </div>
-      <div style="margin-top:8px"><img id="img" alt="snapshot will appear here"></div>
-    </div>
-  </div>
-
-  <div class="sep"></div>
-  <div class="card">
-    <div class="row" style="justify-content:space-between">
-      <b>History (last 6 hours)</b>
-      <button onclick="loadHistory()">Refresh</button>
-    </div>
-    <div class="sep"></div>
-    <canvas id="chartT" height="140"></canvas>
-    <div class="sep"></div>
-    <canvas id="chartH" height="140"></canvas>
-  </div>
-
-<script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.min.js"></script>
-<script>
-let chartT, chartH;
-
-async function api(url, opts) {
-  const r = await fetch(url, opts || {});
-  const j = await r.json();
-  if (!j.ok && j.ok !== undefined) throw new Error(j.error || "api error");
-  return j;
-}
-
-function fmtTs(ts){return new Date(ts*1000).toLocaleTimeString();}
-
-async function refresh() {
-  try {
-    const j = await api('/api/status');
-    document.getElementById('t').textContent = (j.temp!=null && !Number.isNaN(j.temp)) ? j.temp.toFixed(2)+' °C' : '--.- °C';
-    document.getElementById('h').textContent = (j.hum!=null && !Number.isNaN(j.hum)) ? j.hum.toFixed(2)+' %' : '--.- %';
-    document.getElementById('heater').textContent = j.heater ? 'ON' : 'OFF';
-    document.getElementById('fan').textContent = j.fan ? 'ON' : 'OFF';
-    document.getElementById('modeSel').value = j.mode || 'AUTO';
-    document.getElementById('sp_ton').value = j.temp_on?.toFixed(1) ?? '';
-    document.getElementById('sp_toff').value = j.temp_off?.toFixed(1) ?? '';
-    document.getElementById('sp_hon').value = j.hum_on?.toFixed(1) ?? '';
-    document.getElementById('sp_hoff').value = j.hum_off?.toFixed(1) ?? '';
-    document.getElementById('port').textContent = 'Port: ' + (j.port || '--') + (j.updated ? '   Updated: '+fmtTs(j.updated) : '');
-    document.getElementById('meta').textContent = j.updated ? ('Last update: ' + fmtTs(j.updated)) : 'No data yet…';
-  } catch(e) {
-    document.getElementById('meta').textContent = 'Error contacting server';
-    console.error(e);
-  }
-}
-
-async function setMode(mode) {
-  try { await api('/api/mode/'+mode, {method:'POST'}); refresh(); } catch(e){console.error(e);}
-}
-
-async function setDev(dev, state) {
-  try { await api('/api/set/'+dev+'/'+state, {method:'POST'}); refresh(); } catch(e){console.error(e);}
-}
-
-async function saveSetpoints() {
-  const body = {
-    temp_on: parseFloat(document.getElementById('sp_ton').value),
-    temp_off: parseFloat(document.getElementById('sp_toff').value),
-    hum_on: parseFloat(document.getElementById('sp_hon').value),
-    hum_off: parseFloat(document.getElementById('sp_hoff').value),
-  };
-  try {
-    await api('/api/setpoints', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(body)});
-    refresh();
-  } catch(e){ console.error(e); }
-}
-
-
-var CAM_DEV = 0; // set to 1 if your camera is /dev/video1
-
-async function snap() {
-  try {
-    // Trigger a new capture (this also saves latest.jpg server-side)
-    await fetch('/snapshot.jpg?dev=' + CAM_DEV + '&t=' + Date.now());
-    // Now display the saved copy (bust cache with ts)
-    document.getElementById('img').src = '/latest.jpg?t=' + Date.now();
-  } catch(e) {
-    console.error(e);
-  }
-}
-
-async function loadHistory() {
-  const r = await fetch('/api/history?minutes=360');
-  const j = await r.json();
-  const labels = j.ts.map(x => new Date(x*1000).toLocaleTimeString());
-  const temp = j.temp, hum = j.hum;
-  if (chartT) chartT.destroy();
-  if (chartH) chartH.destroy();
-  chartT = new Chart(document.getElementById('chartT'), {
-    type:'line',
-    data:{labels, datasets:[{label:'Temp (°C)', data: temp, tension:0.2, fill:false}]},
-    options:{responsive:true, scales:{y:{beginAtZero:false}}}
-  });
-  chartH = new Chart(document.getElementById('chartH'), {
-    type:'line',
-    data:{labels, datasets:[{label:'Humidity (%)', data: hum, tension:0.2, fill:false}]},
-    options:{responsive:true, scales:{y:{beginAtZero:false}}}
-  });
-}
-
-refresh();
-setInterval(refresh, 5000);
-setTimeout(loadHistory, 1000);
-</script>
-</body>
-</html>
-"""
+# served as-is (no Jinja context), so it is read once rather than rendered per request
+with app.open_resource("templates/index.html") as f:
+    HTML = f.read().decode("utf-8")
+
+# the page never changes at runtime: encode, compress and hash it once
+_HTML_BYTES = HTML.encode("utf-8")
+_HTML_GZ = gzip.compress(_HTML_BYTES, compresslevel=9)
+_HTML_ETAG = hashlib.sha1(_HTML_BYTES).hexdigest()
 
 @app.route("/")
 def home():
-    return Response(HTML, mimetype="text/html")
+    gz = "gzip" in request.headers.get("Accept-Encoding", "")
+    etag = _HTML_ETAG + ("-gz" if gz else "")
+    headers = {"Cache-Control": "public, max-age=300", "Vary": "Accept-Encoding"}
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304, headers=headers)
+    elif gz:
+        headers["Content-Encoding"] = "gzip"
+        resp = Response(_HTML_GZ, mimetype="text/html", headers=headers)
+    else:
+        resp = Response(_HTML_BYTES, mimetype="text/html", headers=headers)
+    resp.set_etag(etag)
+    return resp
 
 @app.route("/api/status")
 def api_status():
-    # if we don't have a recent update, force a GET once
-    if not latest.get("updated") or time.time() - latest["updated"] > POLL_INTERVAL*1.5:
-        send_cmd("GET")
-    out = {k: latest.get(k) for k in ["temp","hum","heater","fan","mode","temp_on","temp_off","hum_on","hum_off","updated","port"]}
+    global _poll_requested
+    # if we don't have a recent update, wake the poller and wait for its GET
+    updated = LATEST.updated
+    if not updated or time.time() - updated > POLL_INTERVAL*1.5:
+        with POLL_COND:
+            # a cycle already in flight may have sent its GET before we got here
+            target = _poll_gen + (2 if _poll_busy else 1)
+            _poll_requested = True
+            POLL_COND.notify_all()
+            POLL_COND.wait_for(lambda: _poll_gen >= target, STATUS_WAIT)
+    out = latest_snapshot(["temp","hum","heater","fan","mode","temp_on","temp_off","hum_on","hum_off","updated","port"])
     out["ok"] = True
     return jsonify(out)
 
@@ -360,13 +287,7 @@ def api_mode(mode):
     st = send_cmd("MODE," + mode)
     d = {"ok": bool(st)}
     if st:
-        d.update({
-            "mode":   latest.get("mode"),
-            "heater": latest.get("heater"),
-            "fan":    latest.get("fan"),
-            "temp":   latest.get("temp"),
-            "hum":    latest.get("hum"),
-        })
+        d.update(latest_snapshot(["mode", "heater", "fan", "temp", "hum"]))
     return jsonify(d)
 
 
@@ -380,13 +301,7 @@ def api_set(dev, state):
     st = send_cmd("SET," + dev + "," + state)
     d = {"ok": bool(st)}
     if st:
-        d.update({
-            "mode":   latest.get("mode"),
-            "heater": latest.get("heater"),
-            "fan":    latest.get("fan"),
-            "temp":   latest.get("temp"),
-            "hum":    latest.get("hum"),
-        })
+        d.update(latest_snapshot(["mode", "heater", "fan", "temp", "hum"]))
     return jsonify(d)
 
 @app.route("/api/setpoints", methods=["POST"])
@@ -403,12 +318,7 @@ def api_setpoints():
     st = send_cmd("GET")
     d = {"ok": ok and bool(st)}
     if st:
-        d.update({
-            "temp_on": latest.get("temp_on"),
-            "temp_off": latest.get("temp_off"),
-            "hum_on": latest.get("hum_on"),
-            "hum_off": latest.get("hum_off"),
-        })
+        d.update(latest_snapshot(["temp_on", "temp_off", "hum_on", "hum_off"]))
     return jsonify(d)
 
 
@@ -416,11 +326,18 @@ def api_setpoints():
 def api_history():
     minutes = float(request.args.get("minutes", "60"))
     since = int(time.time() - minutes*60)
-    rows = db_get_since(since)
-    ts, temp, hum, heater, fan = [], [], [], [], []
-    for r in rows:
-        ts.append(r[0]); temp.append(r[1]); hum.append(r[2]); heater.append(r[3]); fan.append(r[4])
-    return jsonify({"ts": ts, "temp": temp, "hum": hum, "heater": heater, "fan": fan})
+    # ~400 points is all the chart can show; aggregate the rest away in SQLite
+    bucket_s = request.args.get("bucket_s", type=int)  # None if missing or not an int
+    if bucket_s is None:
+        bucket_s = max(int(minutes*60/400), 10)
+    bucket_s = min(max(bucket_s, 1), 3600)
+    rows = db_get_since(since, bucket_s)
+    # transpose rows -> columns in C; jsonify serializes the tuples as arrays
+    ts, temp, hum, heater, fan = zip(*rows) if rows else ((), (), (), (), ())
+    body = {"ts": ts, "temp": temp, "hum": hum, "heater": heater, "fan": fan}
+    if orjson is not None:
+        return Response(orjson.dumps(body), mimetype="application/json")
+    return jsonify(body)
 
 
 
@@ -435,8 +352,35 @@ def _choose_video_device(preferred_index=None):
             return p
     return devs[0]
 
+# one capture at a time: a second fswebcam on the same device just fails with EBUSY
+_CAM_LOCK = threading.Lock()
+_FSWEBCAM = None
+_LAST_JPG = None  # most recent capture, so /latest.jpg doesn't need the disk
+
+def _fswebcam_exe():
+    global _FSWEBCAM
+    if _FSWEBCAM is None:
+        _FSWEBCAM = FSWEBCAM_BIN if os.path.exists(FSWEBCAM_BIN) else shutil.which("fswebcam")
+    return _FSWEBCAM
+
+def _capture_jpeg(exe, device):
+    """Grab one JPEG frame from `device` with fswebcam (caller holds _CAM_LOCK)."""
+    opts = ["-q", "-d", device, "-S", "3", "-r", "1280x720", "--jpeg", "80", "--no-banner"]
+    # First try stdout; if empty, fall back to a temp file
+    cmd = [exe] + opts + ["--save", "-"]
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10, check=True)
+    jpg = p.stdout
+    if not jpg:
+        tmp = "/tmp/_smarthome_snapshot.jpg"
+        cmd2 = [exe] + opts + [tmp]
+        subprocess.run(cmd2, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10, check=True)
+        with open(tmp, "rb") as f:
+            jpg = f.read()
+    return jpg
+
 @app.route("/snapshot.jpg")
 def snapshot():
+    global _LAST_JPG
     # allow override: /snapshot.jpg?dev=1  -> /dev/video1
     dev_arg = request.args.get("dev")
     dev_idx = int(dev_arg) if (dev_arg and dev_arg.isdigit()) else 0
@@ -444,22 +388,21 @@ def snapshot():
     if not device:
         return jsonify({"ok": False, "error": "No /dev/video* devices found"}), 500
 
-    exe = "/usr/bin/fswebcam" if os.path.exists("/usr/bin/fswebcam") else shutil.which("fswebcam")
+    # while a live stream holds the camera, fswebcam would get EBUSY: reuse its frame
+    feed = _FEEDS.get(device)
+    jpg = feed.frame if feed and feed.running else None
+    if jpg:
+        return send_file(io.BytesIO(jpg), mimetype="image/jpeg")
+
+    exe = _fswebcam_exe()
     if not exe:
         return jsonify({"ok": False, "error": "fswebcam not installed"}), 500
 
-    # First try stdout; if empty, fall back to a temp file
-    cmd = [exe, "-q", "-d", device, "-S", "3", "-r", "1280x720", "--no-banner", "--save", "-"]
     try:
-        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10, check=True)
-        jpg = p.stdout
-        if not jpg:
-            tmp = "/tmp/_smarthome_snapshot.jpg"
-            cmd2 = [exe, "-q", "-d", device, "-S", "3", "-r", "1280x720", "--no-banner", tmp]
-            p2 = subprocess.run(cmd2, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10, check=True)
-            with open(tmp, "rb") as f:
-                jpg = f.read()
-        # Save a copy we can serve later
+        with _CAM_LOCK:
+            jpg = _capture_jpeg(exe, device)
+        _LAST_JPG = jpg
+        # Save a copy we can serve later (e.g. after a restart)
         try:
             with open(SNAPSHOT_FILE, "wb") as f:
                 f.write(jpg)
@@ -471,8 +414,167 @@ def snapshot():
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
+STREAM_FPS = 10
+MAX_STREAMS = 2  # each open stream holds a server thread for as long as it runs
+_FEEDS = {}      # device -> _CameraFeed
+_FEEDS_LOCK = threading.Lock()
+_streams = 0
+_FFMPEG = None
+
+def _ffmpeg_exe():
+    global _FFMPEG
+    if _FFMPEG is None:
+        _FFMPEG = FFMPEG_BIN if os.path.exists(FFMPEG_BIN) else shutil.which("ffmpeg")
+    return _FFMPEG
+
+class _CameraFeed:
+    """One long-lived ffmpeg per camera; every /stream.mjpg client shares its frames.
+
+    The process starts with the first client and is killed when the last one leaves.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.cond = threading.Condition()
+        self.frame = None   # latest complete JPEG
+        self.seq = 0        # bumped for every new frame
+        self.clients = 0
+        self.running = False
+        self.proc = None
+
+    def _commands(self, exe):
+        base = [exe, "-loglevel", "error", "-f", "v4l2", "-framerate", str(STREAM_FPS),
+                "-video_size", "1280x720"]
+        return [
+            # camera-side MJPEG: frames are copied through, nothing is encoded here
+            base + ["-input_format", "mjpeg", "-i", self.device, "-c:v", "copy", "-f", "mjpeg", "pipe:1"],
+            # camera has no MJPEG mode: take its raw format and encode
+            base + ["-i", self.device, "-c:v", "mjpeg", "-q:v", "7", "-f", "mjpeg", "pipe:1"],
+        ]
+
+    def acquire(self):
+        """Register a client; returns the frame seq to wait past."""
+        with self.cond:
+            self.clients += 1
+            if not self.running:
+                self.running = True
+                self.frame = None
+                threading.Thread(target=self._run, args=(_ffmpeg_exe(),), daemon=True).start()
+            return self.seq
+
+    def release(self):
+        with self.cond:
+            self.clients -= 1
+            if not self.clients and self.proc:
+                self.proc.kill()
+
+    def wait_frame(self, seq, timeout):
+        """(seq, jpeg) of the first frame newer than `seq`, or (seq, None) on timeout/stop."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq != seq or not self.running, timeout)
+            if self.seq == seq:
+                return seq, None
+            return self.seq, self.frame
+
+    def _run(self, exe):
+        cmds = self._commands(exe)
+        i = 0
+        while True:
+            with self.cond:
+                if not self.clients or i >= len(cmds):
+                    self.running = False
+                    self.proc = None
+                    self.cond.notify_all()
+                    return
+            if not self._pump(cmds[i]):
+                i += 1  # this mode produced nothing (e.g. no MJPEG support): try the next
+
+    def _pump(self, cmd):
+        """Run one ffmpeg and publish its frames until it exits; True if any frame came out."""
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError:
+            return False
+        with self.cond:
+            self.proc = proc
+            if not self.clients:
+                proc.kill()
+        got = False
+        buf = bytearray()
+        try:
+            while True:
+                chunk = proc.stdout.read1(65536)
+                if not chunk:
+                    break
+                buf += chunk
+                # -f mjpeg is just JPEGs back to back: cut at SOI ... EOI
+                while True:
+                    start = buf.find(b"\xff\xd8")
+                    end = buf.find(b"\xff\xd9", start + 2) if start >= 0 else -1
+                    if end < 0:
+                        break
+                    jpg = bytes(buf[start:end + 2])
+                    del buf[:end + 2]
+                    got = True
+                    with self.cond:
+                        self.frame = jpg
+                        self.seq += 1
+                        self.cond.notify_all()
+        finally:
+            proc.kill()
+            proc.wait()
+        return got
+
+@app.route("/stream.mjpg")
+def stream_mjpg():
+    global _streams
+    dev_arg = request.args.get("dev")
+    dev_idx = int(dev_arg) if (dev_arg and dev_arg.isdigit()) else 0
+    device = _choose_video_device(dev_idx)
+    if not device:
+        return jsonify({"ok": False, "error": "No /dev/video* devices found"}), 500
+    if not _ffmpeg_exe():
+        return jsonify({"ok": False, "error": "ffmpeg not installed"}), 500
+
+    with _FEEDS_LOCK:
+        if _streams >= MAX_STREAMS:
+            return jsonify({"ok": False, "error": "too many live streams"}), 503
+        _streams += 1
+        feed = _FEEDS.setdefault(device, _CameraFeed(device))
+
+    closed = []
+    def close():
+        global _streams
+        if closed:
+            return
+        closed.append(True)
+        feed.release()
+        with _FEEDS_LOCK:
+            _streams -= 1
+
+    seq = feed.acquire()
+    seq, jpg = feed.wait_frame(seq, timeout=10.0)
+    if jpg is None:
+        close()
+        return jsonify({"ok": False, "error": "camera produced no frames"}), 500
+
+    def frames(seq, jpg):
+        global _LAST_JPG
+        while jpg is not None:
+            _LAST_JPG = jpg
+            yield b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + jpg + b"\r\n"
+            seq, jpg = feed.wait_frame(seq, timeout=5.0)
+
+    resp = Response(frames(seq, jpg), mimetype="multipart/x-mixed-replace; boundary=frame")
+    # runs on client disconnect too, even if the generator was never started
+    resp.call_on_close(close)
+    return resp
+
 @app.route("/latest.jpg")
 def latest_jpg():
+    jpg = _LAST_JPG
+    if jpg:
+        return send_file(io.BytesIO(jpg), mimetype="image/jpeg")
     if not os.path.exists(SNAPSHOT_FILE):
         return jsonify({"ok": False, "error": "No snapshot yet"}), 404
     return send_file(SNAPSHOT_FILE, mimetype="image/jpeg")
@@ -482,11 +584,19 @@ def latest_jpg():
 
 def main():
     db_init()
+    # SystemExit runs the atexit hook, so buffered readings are flushed on SIGTERM too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     # kick one GET so UI has values quickly
     try: send_cmd("GET")
     except: pass
     threading.Thread(target=poller, daemon=True).start()
-    app.run(host="0.0.0.0", port=8000)
+    try:
+        from waitress import serve
+    except ImportError:
+        # dev server fallback; still one thread per request
+        app.run(host="0.0.0.0", port=8000, threaded=True)
+    else:
+        serve(app, host="0.0.0.0", port=8000, threads=8)
 
 if __name__ == "__main__":
     main()
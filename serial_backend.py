@@ -0,0 +1,177 @@
+# serial_backend.py
+# Fully annotated so the hot path can be compiled with mypyc:
+#   mypyc serial_backend.py   -> serial_backend.*.so, picked up by `import serial_backend`
+import glob, logging, re, time
+from typing import Any, Callable, Final, Optional, Union
+import serial  # type: ignore[import-untyped]
+
+log = logging.getLogger(__name__)
+
+StatusFields = dict[str, Union[float, int, str]]
+
+# how long to wait for a reply: the sketch answers within ~1 s, older sketches
+# only read serial once per ~2.3 s loop
+REPLY_WAIT: Final = 3.0
+# untagged-only answers in a row before concluding the firmware ignores tags
+TAG_FALLBACK_AFTER: Final = 3
+
+# module-level Final constants stay C-level references under mypyc
+_STATUS_RE: Final = re.compile(rb"(\w+)=([^,\s]+)")
+
+def _mode(v: bytes) -> str:
+    return v.decode("ascii").upper()
+
+# field name -> (Status attribute, converter); float() also accepts b"nan"
+_STATUS_FIELDS: Final[dict[bytes, tuple[str, Callable[[bytes], Union[float, int, str]]]]] = {
+    b"temp": ("temp", float), b"hum": ("hum", float),
+    b"temp_on": ("temp_on", float), b"temp_off": ("temp_off", float),
+    b"hum_on": ("hum_on", float), b"hum_off": ("hum_off", float),
+    b"heater": ("heater", int), b"fan": ("fan", int),
+    b"mode": ("mode", _mode),
+}
+
+def parse_status(line: bytes) -> Optional[StatusFields]:
+    # b"STATUS,temp=23.45,hum=51.20,heater=0,fan=1,mode=AUTO,temp_on=20.0,..."
+    try:
+        out: StatusFields = {}
+        for k, v in _STATUS_RE.findall(line):
+            field = _STATUS_FIELDS.get(k)
+            if field:
+                out[field[0]] = field[1](v)
+        return out
+    except Exception:
+        return None
+
+
+class SerialSource:
+    """The one owner of the controller's serial port.
+
+    `parse` turns a reply line (bytes starting with `prefix`) into a dict.
+    Not thread-safe: callers serialize access (app.LOCK).
+    """
+
+    def __init__(self, baud: int, globs: list[str], timeout: float,
+                 parse: Callable[[bytes], Optional[StatusFields]] = parse_status,
+                 prefix: bytes = b"STATUS,") -> None:
+        self.baud = baud
+        self.globs = globs
+        self.timeout = timeout
+        self.parse = parse
+        self.prefix = prefix
+        self.ser: Any = None
+        self.port: Optional[str] = None
+        self._rxbuf = bytearray()  # bytes read but not yet returned as a line
+        self._seq = 0              # request id, echoed back by the firmware
+        self.tagged = True         # False once the firmware is known not to echo seq
+        self._untagged_hits = 0    # consecutive tagged timeouts answered only untagged
+
+    def find_port(self) -> Optional[str]:
+        for pat in self.globs:
+            matches = sorted(glob.glob(pat))
+            if matches:
+                return matches[0]
+        return None
+
+    @property
+    def is_open(self) -> bool:
+        return self.ser is not None and bool(self.ser.is_open)
+
+    def open(self) -> Any:
+        port = self.find_port()
+        if not port:
+            return None
+        self.ser = serial.Serial(port, self.baud, timeout=self.timeout)
+        del self._rxbuf[:]
+        self.tagged = True  # may be a different (reflashed) board now
+        self._untagged_hits = 0
+        time.sleep(2.0)  # allow MCU reset
+        self.port = port
+        return self.ser
+
+    def readline(self, deadline: float) -> Optional[bytes]:
+        """Next line from the port, or None once `deadline` passes.
+
+        pyserial's readline() does one read(1) per byte; this pulls whatever the
+        driver already has in a single read and splits lines out of _rxbuf.
+        """
+        buf = self._rxbuf
+        while True:
+            i = buf.find(b"\n")
+            if i >= 0:
+                line = bytes(buf[:i])
+                del buf[:i + 1]
+                return line
+            if time.monotonic() >= deadline:
+                return None
+            # blocks (up to timeout) for the first byte, then takes the rest in one go;
+            # an empty read just means quiet so far, the deadline decides when to stop
+            chunk: bytes = self.ser.read(self.ser.in_waiting or 1)
+            buf.extend(chunk)
+
+    def request(self, cmd: str, wait: float = REPLY_WAIT) -> Optional[tuple[bytes, Optional[StatusFields]]]:
+        """Send `cmd`; return (reply line, parsed reply) or None if nothing came back.
+
+        Commands go out as "<seq>,<cmd>" and the firmware answers "STATUS,<seq>,...",
+        so a healthy port needs no input flush: stale replies are recognised and skipped.
+        Older firmware ignores tagged commands; then we fall back to plain "<cmd>".
+        """
+        if not self.is_open:
+            if not self.open():
+                return None
+            # cold path: drop whatever the MCU printed while booting
+            self._flush_input()
+        if not self.tagged:
+            # untagged replies can't be matched, so flush anything stale first
+            self._flush_input()
+            line = self._exchange(cmd.encode("utf-8"), None, wait)
+            return None if line is None else (line, self.parse(line))
+
+        self._seq = self._seq % 9999 + 1
+        tag = str(self._seq).encode("ascii")
+        line = self._exchange(tag + b"," + cmd.encode("utf-8"), tag, wait)
+        if line is not None:
+            self._untagged_hits = 0
+            return line, self.parse(line)
+        # No tagged answer: slow firmware, or one that ignores tags. Probe untagged
+        # on an empty buffer so whatever answers is a reply to this very command.
+        self._flush_input()
+        line = self._exchange(cmd.encode("utf-8"), None, wait)
+        if line is None:
+            return None
+        if self._reply_seq(line) is not None:
+            self._untagged_hits = 0  # a (late) tagged reply: tags do work
+        else:
+            self._untagged_hits += 1
+            if self._untagged_hits >= TAG_FALLBACK_AFTER:
+                self.tagged = False
+                log.warning("firmware on %s does not echo command tags; using untagged commands "
+                            "(reflash ClimateOne.ino to enable them)", self.port)
+        return line, self.parse(line)
+
+    def _flush_input(self) -> None:
+        self.ser.reset_input_buffer()
+        del self._rxbuf[:]
+
+    def _reply_seq(self, line: bytes) -> Optional[bytes]:
+        """The seq echoed in a STATUS line, or None for an untagged one."""
+        seq = line[len(self.prefix):].partition(b",")[0]
+        return seq if seq.isdigit() else None
+
+    def _exchange(self, out: bytes, tag: Optional[bytes], wait: float) -> Optional[bytes]:
+        """Write one command line; return the STATUS reply, or None on timeout.
+
+        With `tag`, only a reply echoing it counts (untagged and stale lines are
+        skipped); without, the first STATUS line does (caller flushed the input).
+        """
+        self.ser.write(out + b"\n")
+        self.ser.flush()
+        deadline = time.monotonic() + wait
+        while True:
+            line = self.readline(deadline)
+            if line is None:
+                return None  # timed out, nothing more is coming
+            line = line.strip()
+            if not line.startswith(self.prefix):
+                continue
+            if tag is None or self._reply_seq(line) == tag:
+                return line